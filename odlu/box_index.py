@@ -0,0 +1,38 @@
+from typing import List
+
+import numpy as np
+
+
+class BoxIndex:
+    # Vectorized point in box lookup over the complete boxes of an image, cheap
+    # enough to rebuild whenever the boxes change
+    def __init__(self, bboxes: List):
+        complete = [
+            (index, bbox)
+            for index, bbox in enumerate(bboxes)
+            if bbox.corner2 is not None
+        ]
+        self.indices = np.array([index for index, _ in complete], dtype=np.int64)
+        self.boxes = np.array(
+            [
+                [bbox.corner1.x, bbox.corner1.y, bbox.corner2.x, bbox.corner2.y]
+                for _, bbox in complete
+            ],
+            dtype=np.float64,
+        ).reshape(-1, 4)
+        self.areas = (self.boxes[:, 2] - self.boxes[:, 0]) * (
+            self.boxes[:, 3] - self.boxes[:, 1]
+        )
+
+    def hit_test(self, x: float, y: float) -> int:
+        # returns the index of the smallest box containing the point, so nested
+        # boxes can still be selected, or None
+        inside = np.nonzero(
+            (self.boxes[:, 0] <= x)
+            & (x <= self.boxes[:, 2])
+            & (self.boxes[:, 1] <= y)
+            & (y <= self.boxes[:, 3])
+        )[0]
+        if len(inside) == 0:
+            return None
+        return int(self.indices[inside[np.argmin(self.areas[inside])]])
@@ -0,0 +1,13 @@
+import re
+
+# Subdirectories of the local data dir and of the s3 data prefix
+IMAGE_DIR_NAME = "images"
+ANNOTATION_DIR_NAME = "annotations"
+MANIFEST_DIR_NAME = "manifests"
+
+
+def manifest_file_sort(manifest_file) -> int:
+    match = re.match("[0-9]+", manifest_file)
+    if not match:
+        return 0
+    return int(match[0])
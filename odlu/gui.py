@@ -10,9 +10,13 @@ import matplotlib.patches as patches
 import matplotlib.pyplot as plt
 from matplotlib.widgets import Button
 import numpy as np
-from pascal_voc_writer import Writer
 from PIL import Image
 
+from box_index import BoxIndex
+from image_cache import ImageCache
+from pascal_voc import PascalVocObject
+from pyramid import TilePyramid
+
 matplotlib.use("TKAgg")
 
 
@@ -27,6 +31,7 @@ class BBox:
     corner1: BBoxCorner
     corner2: BBoxCorner
     category: str
+    proposed: bool = False
 
 
 class AnnotatedImage:
@@ -35,6 +40,12 @@ class AnnotatedImage:
         self.annotation_base_dir = annotation_base_dir
         self.bboxes: List[BBox] = []
         self.valid = True
+        self.proposals_loaded = False
+        # existing annotation file of an image being reviewed
+        self.annotation_path: str = None
+        self.annotations_loaded = False
+        # an unreadable annotation file is never overwritten
+        self.annotation_load_failed = False
 
     # use the base image filename for the output annotation xml file
     def _get_pascal_voc_filename(self) -> str:
@@ -44,29 +55,29 @@ class AnnotatedImage:
             return os.path.splitext(os.path.basename(self.image_path))[0] + ".xml"
 
     def remove_incomplete_boxes(self) -> None:
-        for bbox in self.bboxes:
-            if bbox.corner2 is None:
-                self.bboxes.remove(bbox)
+        # removing while iterating would skip the box after each removed one
+        self.bboxes[:] = [bbox for bbox in self.bboxes if bbox.corner2 is not None]
 
-    def write_to_pascal_voc(self) -> str:
-        if len(self.bboxes) == 0 or not self.valid:
+    def remove_proposed_boxes(self) -> None:
+        self.bboxes[:] = [bbox for bbox in self.bboxes if not bbox.proposed]
+
+    def get_pascal_voc_path(self) -> str:
+        # reviewed images are rewritten even when all of their boxes were removed
+        if not self.valid or (len(self.bboxes) == 0 and self.annotation_path is None):
             return None
-        width, height = Image.open(self.image_path).size
-        writer = Writer(self.image_path, width, height)
-        annotation_path = os.path.join(
-            self.annotation_base_dir, self._get_pascal_voc_filename()
-        )
-        self.remove_incomplete_boxes()
-        for bbox in self.bboxes:
-            writer.addObject(
+        return os.path.join(self.annotation_base_dir, self._get_pascal_voc_filename())
+
+    def get_pascal_voc_objects(self) -> List[PascalVocObject]:
+        return [
+            (
                 bbox.category,
                 bbox.corner1.x,
                 bbox.corner1.y,
                 bbox.corner2.x,
                 bbox.corner2.y,
             )
-        writer.save(annotation_path)
-        return annotation_path
+            for bbox in self.bboxes
+        ]
 
 
 class Category:
@@ -117,8 +128,40 @@ class GUI:
 
     BOX_SIDES = ["left", "right", "top", "bottom"]
 
-    def __init__(self, fig):
+    UNKNOWN_CATEGORY_COLOR = "black"
+    SELECTED_BBOX_LINE_WIDTH = 4
+
+    PROPOSAL_POLL_INTERVAL_MS = 100
+
+    VIEWPORT_ZOOM_STEP = 1.25
+    VIEWPORT_PAN_FRACTION = 0.25
+    VIEWPORT_MIN_SPAN = 16
+    VIEWPORT_KEYS = ["left", "right", "up", "down", "+", "=", "-", "r"]
+
+    def __init__(
+        self,
+        fig,
+        tile_cache_dir: str = None,
+        tile_size: int = 512,
+        tile_cache_size_bytes: int = None,
+        image_cache: ImageCache = None,
+    ):
         self.fig = fig
+        self.image_cache = image_cache
+        self.pre_annotator = None
+        self.proposal_timer = None
+        self.annotation_loader = None
+        self.box_index = BoxIndex([])
+        self.selected_bbox: int = None
+        self.drag_start: BBoxCorner = None
+        self.drag_origin: BBox = None
+        self.tile_cache_dir = tile_cache_dir
+        self.tile_size = tile_size
+        self.tile_cache_size_bytes = tile_cache_size_bytes
+        self.pyramid: TilePyramid = None
+        self.tile_image = None
+        # (width, height) of the displayed image in full resolution pixels
+        self.image_size = (0, 0)
         self.categories: Dict[str, Category] = dict()
         self.current_category: str = None
         self.images: List[AnnotatedImage] = []
@@ -151,16 +194,28 @@ class GUI:
         self.fig.canvas.mpl_connect("button_press_event", self._on_click)
         self.fig.canvas.mpl_connect("key_press_event", self._on_keypress)
         self.fig.canvas.mpl_connect("motion_notify_event", self._on_mouse_motion)
+        self.fig.canvas.mpl_connect("button_release_event", self._on_release)
+
+        if self.tile_cache_dir is not None:
+            self.image_ax.set_autoscale_on(False)
+            self._remove_default_viewport_keymaps()
+            self.fig.canvas.mpl_connect("scroll_event", self._on_scroll)
 
     def show(self) -> None:
         # Display the first image
         self._display_image(self.images[self.image_index].image_path)
+        self._load_annotations()
+        self._load_proposals()
+        self._draw_bounding_boxes(self.images[self.image_index].bboxes)
         # Select the first category as default
         self.current_category = next(iter(self.categories))
         self.categories[self.current_category].select()
         plt.show()
 
         print("Closed window")
+        # proposals that were never accepted by moving to the next image are not saved
+        for image in self.images:
+            image.remove_proposed_boxes()
         return self._get_annotated_images()
 
     def _get_utility_ax_rect(self, utility_index) -> List[int]:
@@ -191,38 +246,234 @@ class GUI:
     def add_image(self, image: AnnotatedImage) -> None:
         self.images.append(image)
 
+    def set_pre_annotator(self, pre_annotator) -> None:
+        self.pre_annotator = pre_annotator
+
+    def set_annotation_loader(self, annotation_loader) -> None:
+        self.annotation_loader = annotation_loader
+
     def _get_annotated_images(self) -> List[AnnotatedImage]:
         return [
             image
             for image in self.images[: self.image_index + 1]
-            if len(image.bboxes) > 0 or not image.valid
+            if not image.annotation_load_failed
+            and (
+                len(image.bboxes) > 0
+                or not image.valid
+                or image.annotation_path is not None
+            )
         ]
 
     def _display_image(self, path) -> None:
-        img = Image.open(path)
-        self.image_ax.imshow(img)
+        if self.tile_cache_dir is not None:
+            self.pyramid = TilePyramid(
+                path, self.tile_cache_dir, self.tile_size, self.tile_cache_size_bytes
+            )
+            self._reset_viewport()
+            self.image_size = (self.pyramid.width, self.pyramid.height)
+        elif self.image_cache is not None:
+            # release the memory map of the previous frame
+            [i.remove() for i in reversed(self.image_ax.images)]
+            # the cached frame is display resolution, stretch it over the full
+            # resolution pixel space so bounding boxes keep their coordinates
+            width, height = Image.open(path).size
+            self.image_ax.imshow(
+                self.image_cache.get(path),
+                extent=(-0.5, width - 0.5, height - 0.5, -0.5),
+            )
+            self.image_size = (width, height)
+        else:
+            img = Image.open(path)
+            self.image_ax.imshow(img)
+            self.image_size = img.size
         self.image_ax.set_title(
             "%s [%i/%i]" % (path.split("/")[-1], self.image_index + 1, len(self.images))
         )
         self._refresh()
 
+    def _remove_default_viewport_keymaps(self) -> None:
+        # stop the matplotlib navigation shortcuts from fighting the viewport keys
+        for param in plt.rcParams:
+            if param.startswith("keymap."):
+                plt.rcParams[param] = [
+                    key for key in plt.rcParams[param] if key not in self.VIEWPORT_KEYS
+                ]
+
+    def _render_viewport(self) -> None:
+        x_min, x_max = self.image_ax.get_xlim()
+        y_max, y_min = self.image_ax.get_ylim()
+        screen_width = self.image_ax.get_window_extent().width
+        level = self.pyramid.get_level_for_scale((x_max - x_min) / screen_width)
+        tiles, extent = self.pyramid.get_view(level, x_min, x_max, y_min, y_max)
+        if self.tile_image is not None:
+            self.tile_image.remove()
+        self.tile_image = self.image_ax.imshow(tiles, extent=extent, zorder=0)
+        self._refresh()
+
+    def _set_viewport(self, x_min: float, x_max: float, y_min: float, y_max: float):
+        # keep the view inside the image, y is flipped to match imshow
+        width, height = self.pyramid.width, self.pyramid.height
+        x_span = min(max(x_max - x_min, self.VIEWPORT_MIN_SPAN), width)
+        y_span = min(max(y_max - y_min, self.VIEWPORT_MIN_SPAN), height)
+        x_min = min(max(x_min, -0.5), width - 0.5 - x_span)
+        y_min = min(max(y_min, -0.5), height - 0.5 - y_span)
+        self.image_ax.set_xlim(x_min, x_min + x_span)
+        self.image_ax.set_ylim(y_min + y_span, y_min)
+        self._render_viewport()
+
+    def _reset_viewport(self) -> None:
+        self._set_viewport(
+            -0.5, self.pyramid.width - 0.5, -0.5, self.pyramid.height - 0.5
+        )
+
+    def _zoom_viewport(self, factor: float, x_center: float, y_center: float):
+        x_min, x_max = self.image_ax.get_xlim()
+        y_max, y_min = self.image_ax.get_ylim()
+        self._set_viewport(
+            x_center - (x_center - x_min) * factor,
+            x_center + (x_max - x_center) * factor,
+            y_center - (y_center - y_min) * factor,
+            y_center + (y_max - y_center) * factor,
+        )
+
+    def _pan_viewport(self, x_direction: int, y_direction: int) -> None:
+        x_min, x_max = self.image_ax.get_xlim()
+        y_max, y_min = self.image_ax.get_ylim()
+        x_step = x_direction * (x_max - x_min) * self.VIEWPORT_PAN_FRACTION
+        y_step = y_direction * (y_max - y_min) * self.VIEWPORT_PAN_FRACTION
+        self._set_viewport(
+            x_min + x_step, x_max + x_step, y_min + y_step, y_max + y_step
+        )
+
+    def _handle_viewport_key(self, key: str) -> None:
+        x_min, x_max = self.image_ax.get_xlim()
+        y_max, y_min = self.image_ax.get_ylim()
+        x_center, y_center = (x_min + x_max) / 2, (y_min + y_max) / 2
+        if key == "+" or key == "=":
+            self._zoom_viewport(1 / self.VIEWPORT_ZOOM_STEP, x_center, y_center)
+        elif key == "-":
+            self._zoom_viewport(self.VIEWPORT_ZOOM_STEP, x_center, y_center)
+        elif key == "left":
+            self._pan_viewport(-1, 0)
+        elif key == "right":
+            self._pan_viewport(1, 0)
+        elif key == "up":
+            self._pan_viewport(0, -1)
+        elif key == "down":
+            self._pan_viewport(0, 1)
+        elif key == "r":
+            self._reset_viewport()
+
+    def _on_scroll(self, event) -> None:
+        if event.inaxes != self.image_ax or event.xdata is None:
+            return
+        if event.button == "up":
+            self._zoom_viewport(1 / self.VIEWPORT_ZOOM_STEP, event.xdata, event.ydata)
+        elif event.button == "down":
+            self._zoom_viewport(self.VIEWPORT_ZOOM_STEP, event.xdata, event.ydata)
+
+    def _load_annotations(self) -> None:
+        if self.annotation_loader is None:
+            return
+        image = self.images[self.image_index]
+        if image.annotation_path is not None and not image.annotations_loaded:
+            image.annotations_loaded = True
+            objects = self.annotation_loader.get_objects(image.annotation_path)
+            if objects is None:
+                image.annotation_load_failed = True
+                print("Annotation %s is left unchanged" % image.annotation_path)
+                objects = []
+            for category, x_min, y_min, x_max, y_max in objects:
+                if category not in self.categories:
+                    print(
+                        "Unknown category %s in %s" % (category, image.annotation_path)
+                    )
+                image.bboxes.append(
+                    BBox(BBoxCorner(x_min, y_min), BBoxCorner(x_max, y_max), category)
+                )
+        # parse the upcoming annotation files while this image is being reviewed
+        prefetch_end = self.image_index + 1 + self.annotation_loader.prefetch_count
+        self.annotation_loader.prefetch(
+            [
+                upcoming.annotation_path
+                for upcoming in self.images[self.image_index + 1 : prefetch_end]
+                if not upcoming.annotations_loaded
+            ]
+        )
+
+    def _load_proposals(self) -> None:
+        image = self.images[self.image_index]
+        if self.pre_annotator is None or image.proposals_loaded:
+            return
+        if not self.pre_annotator.proposals_ready(image.image_path):
+            # poll from the Tk event loop instead of blocking it on the workers
+            if self.proposal_timer is None:
+                self.proposal_timer = self.fig.canvas.new_timer(
+                    interval=self.PROPOSAL_POLL_INTERVAL_MS
+                )
+                self.proposal_timer.add_callback(self._poll_proposals)
+                self.proposal_timer.start()
+            return
+        image.proposals_loaded = True
+        if not image.valid or image.annotation_load_failed or len(image.bboxes) > 0:
+            return
+        for proposal in self.pre_annotator.get_proposals(image.image_path):
+            image.bboxes.append(
+                BBox(
+                    BBoxCorner(proposal["xmin"], proposal["ymin"]),
+                    BBoxCorner(proposal["xmax"], proposal["ymax"]),
+                    proposal["category"],
+                    proposed=True,
+                )
+            )
+
+    def _poll_proposals(self) -> None:
+        # always checks the displayed image, proposals of images the labeler moved
+        # away from are loaded when the image is displayed again
+        image = self.images[self.image_index]
+        if image.proposals_loaded or self.pre_annotator.proposals_ready(
+            image.image_path
+        ):
+            self.proposal_timer.stop()
+            self.proposal_timer = None
+            if not image.proposals_loaded:
+                self._load_proposals()
+                self._draw_bounding_boxes(image.bboxes)
+
+    def _accept_proposals(self) -> None:
+        for bbox in self.images[self.image_index].bboxes:
+            bbox.proposed = False
+
+    def _reject_proposals(self, event) -> None:
+        self._deselect_bbox()
+        self._clear_all_lines()
+        image = self.images[self.image_index]
+        image.remove_proposed_boxes()
+        self._draw_bounding_boxes(image.bboxes)
+
     def _next_image(self, event) -> None:
+        self._deselect_bbox()
         self.images[self.image_index].remove_incomplete_boxes()
         self._clear_all_lines()
+        self._accept_proposals()
         if self.image_index == len(self.images) - 1:
             plt.close()
         else:
             self.image_index += 1
             self._display_image(self.images[self.image_index].image_path)
+            self._load_annotations()
+            self._load_proposals()
             self._draw_bounding_boxes(self.images[self.image_index].bboxes)
             self._draw_image_border()
 
     def _prev_image(self, event) -> None:
+        self._deselect_bbox()
         self._clear_all_lines()
         if self.image_index != 0:
             self.images[self.image_index].remove_incomplete_boxes()
             self.image_index -= 1
             self._display_image(self.images[self.image_index].image_path)
+            self._load_proposals()
             self._draw_bounding_boxes(self.images[self.image_index].bboxes)
             self._draw_image_border()
 
@@ -265,19 +516,28 @@ class GUI:
     def _draw_bounding_boxes(self, bboxes) -> None:
         # clear all current boxes
         [p.remove() for p in reversed(self.image_ax.patches)]
+        self.box_index = BoxIndex(bboxes)
         # redraw the boxes
-        for bbox in bboxes:
+        for bbox_index, bbox in enumerate(bboxes):
             if bbox.corner2 is None:
                 continue
             height = bbox.corner2.y - bbox.corner1.y
             width = bbox.corner2.x - bbox.corner1.x
             lower_left = (bbox.corner1.x, bbox.corner1.y)
-            color = self.categories[bbox.category].color
+            color = (
+                self.categories[bbox.category].color
+                if bbox.category in self.categories
+                else self.UNKNOWN_CATEGORY_COLOR
+            )
+            linewidth = (
+                self.SELECTED_BBOX_LINE_WIDTH if bbox_index == self.selected_bbox else 2
+            )
             rect = patches.Rectangle(
                 lower_left,
                 width,
                 height,
-                linewidth=2,
+                linewidth=linewidth,
+                linestyle="dashed" if bbox.proposed else "solid",
                 edgecolor=color,
                 facecolor="none",
             )
@@ -288,12 +548,16 @@ class GUI:
         if not self.images[self.image_index].valid:
             print("Image marked as invalid. Cannot draw bounding box")
             return
+        if self.images[self.image_index].annotation_load_failed:
+            print("Annotation could not be read. Cannot draw bounding box")
+            return
         bboxes = self.images[self.image_index].bboxes
         if len(bboxes) > 0 and bboxes[-1].corner2 is None:
             self._clear_all_lines()
             bboxes[-1].corner2 = BBoxCorner(
                 math.floor(event.xdata), math.floor(event.ydata)
             )
+            bboxes[-1].proposed = False
             self._format_corners(bboxes[-1])
             self._draw_bounding_boxes(bboxes)
         else:
@@ -306,6 +570,65 @@ class GUI:
             )
             self._draw_corner_1_lines(bboxes[-1].corner1.x, bboxes[-1].corner1.y)
 
+    def _select_bbox(self, event) -> None:
+        bboxes = self.images[self.image_index].bboxes
+        if len(bboxes) > 0 and bboxes[-1].corner2 is None:
+            print("Finish the current bounding box before selecting another")
+            return
+        self.selected_bbox = self.box_index.hit_test(event.xdata, event.ydata)
+        if self.selected_bbox is not None:
+            # start moving the selected box until the button is released
+            selected = bboxes[self.selected_bbox]
+            self.drag_start = BBoxCorner(event.xdata, event.ydata)
+            self.drag_origin = BBox(
+                BBoxCorner(selected.corner1.x, selected.corner1.y),
+                BBoxCorner(selected.corner2.x, selected.corner2.y),
+                selected.category,
+            )
+        self._draw_bounding_boxes(bboxes)
+
+    def _deselect_bbox(self) -> None:
+        self.selected_bbox = None
+        self.drag_start = None
+        self.drag_origin = None
+
+    def _move_selected_bbox(self, event) -> None:
+        selected = self.images[self.image_index].bboxes[self.selected_bbox]
+        width, height = self.image_size
+        # keep both corners of the moved box inside the image
+        x_offset = max(
+            min(
+                math.floor(event.xdata - self.drag_start.x),
+                width - 1 - self.drag_origin.corner2.x,
+            ),
+            -self.drag_origin.corner1.x,
+        )
+        y_offset = max(
+            min(
+                math.floor(event.ydata - self.drag_start.y),
+                height - 1 - self.drag_origin.corner2.y,
+            ),
+            -self.drag_origin.corner1.y,
+        )
+        selected.corner1 = BBoxCorner(
+            self.drag_origin.corner1.x + x_offset, self.drag_origin.corner1.y + y_offset
+        )
+        selected.corner2 = BBoxCorner(
+            self.drag_origin.corner2.x + x_offset, self.drag_origin.corner2.y + y_offset
+        )
+        selected.proposed = False
+        self._draw_bounding_boxes(self.images[self.image_index].bboxes)
+
+    def _delete_selected_bbox(self, event) -> None:
+        bboxes = self.images[self.image_index].bboxes
+        if self.selected_bbox is None or self.selected_bbox >= len(bboxes):
+            print("No bounding box selected")
+            self._deselect_bbox()
+            return
+        del bboxes[self.selected_bbox]
+        self._deselect_bbox()
+        self._draw_bounding_boxes(self.images[self.image_index].bboxes)
+
     def _draw_invalid_image_border(self) -> None:
         for side in self.BOX_SIDES:
             self.image_ax.spines[side].set_linewidth(self.INVALID_IMAGE_BORDER_WIDTH)
@@ -323,6 +646,10 @@ class GUI:
             self._draw_valid_image_border()
 
     def _toggle_image_validation(self, event) -> None:
+        if self.images[self.image_index].annotation_load_failed:
+            print("Annotation could not be read. Cannot change image validity")
+            return
+        self._deselect_bbox()
         self.images[self.image_index].valid = not self.images[self.image_index].valid
         self.images[self.image_index].bboxes.clear()
         self._clear_all_lines()
@@ -330,6 +657,7 @@ class GUI:
         self._draw_image_border()
 
     def _undo_latest(self, event) -> None:
+        self._deselect_bbox()
         self._clear_all_lines()
         if len(self.images[self.image_index].bboxes) == 0:
             print("No more bounding boxes to clear")
@@ -352,7 +680,10 @@ class GUI:
         # verify that the click was inbounds for an axes
         if event.xdata is None or event.ydata is None or event.inaxes is None:
             return
+        elif event.inaxes == self.image_ax and event.button == 3:
+            self._select_bbox(event)
         elif event.inaxes == self.image_ax:
+            self._deselect_bbox()
             self._handle_bbox_entry(event)
         elif event.inaxes == self.next_ax:
             self._next_image(event)
@@ -378,6 +709,12 @@ class GUI:
             self._prev_image(event)
         elif event.key == "w" or event.key == "escape":
             self._undo_latest(event)
+        elif event.key == "x":
+            self._reject_proposals(event)
+        elif event.key == "delete" or event.key == "backspace":
+            self._delete_selected_bbox(event)
+        elif self.tile_cache_dir is not None and event.key in self.VIEWPORT_KEYS:
+            self._handle_viewport_key(event.key)
         for category_name, category in self.categories.items():
             if event.key == category.keyboard_string:
                 self.current_category = category_name
@@ -385,7 +722,14 @@ class GUI:
                 category.select()
         self._refresh()
 
+    def _on_release(self, event) -> None:
+        self.drag_start = None
+        self.drag_origin = None
+
     def _on_mouse_motion(self, event) -> None:
+        if self.drag_start is not None and event.inaxes == self.image_ax:
+            self._move_selected_bbox(event)
+            return
         if event.inaxes is None or event.inaxes != self.image_ax:
             if (
                 len(self.images[self.image_index].bboxes) == 0
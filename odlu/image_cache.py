@@ -0,0 +1,106 @@
+import hashlib
+import os
+import pathlib
+from typing import Dict, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+def get_file_hash(file_path: str) -> str:
+    file_hash = hashlib.sha1()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+
+def get_image_cache_key(image_path: str) -> str:
+    # cheap key for caches of data derived from an image (or model) file
+    stat = os.stat(image_path)
+    key = "%s:%i:%i" % (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()
+
+
+class ImageCache:
+    # Decoded display resolution frames stored as .npy files keyed by the hash of
+    # the image file contents. Files are only ever created by an atomic rename and
+    # their modification time is used as the LRU clock, so several labeler
+    # processes on one host can share the same cache directory.
+    FRAME_FILE_TYPE = ".npy"
+
+    def __init__(self, cache_dir: str, max_size_bytes: int, max_dimension: int):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        self.max_dimension = max_dimension
+        # (path, size, mtime) -> file hash, avoids rehashing within a session
+        self.file_hashes: Dict[Tuple[str, int, int], str] = dict()
+        pathlib.Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+
+    def _frame_path(self, image_path: str) -> str:
+        stat = os.stat(image_path)
+        key = (os.path.abspath(image_path), stat.st_size, stat.st_mtime_ns)
+        if key not in self.file_hashes:
+            self.file_hashes[key] = get_file_hash(image_path)
+        frame_file_name = "%s-%i%s" % (
+            self.file_hashes[key],
+            self.max_dimension,
+            self.FRAME_FILE_TYPE,
+        )
+        return os.path.join(self.cache_dir, frame_file_name)
+
+    def _decode(self, image_path: str) -> np.ndarray:
+        image = Image.open(image_path)
+        # let the JPEG decoder skip the resolution we are about to throw away
+        image.draft("RGB", (self.max_dimension, self.max_dimension))
+        image = image.convert("RGB")
+        image.thumbnail((self.max_dimension, self.max_dimension), Image.BILINEAR)
+        return np.asarray(image)
+
+    def _store(self, frame_path: str, frame: np.ndarray) -> None:
+        tmp_path = "%s.%i.tmp" % (frame_path, os.getpid())
+        with open(tmp_path, "wb") as tmp_file:
+            np.save(tmp_file, frame)
+        os.replace(tmp_path, frame_path)
+
+    def _evict(self) -> None:
+        frames = []
+        for file_name in os.listdir(self.cache_dir):
+            if not file_name.endswith(self.FRAME_FILE_TYPE):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                # evicted by another process
+                continue
+            frames.append((stat.st_mtime, stat.st_size, file_name))
+
+        total_size = sum(size for _, size, _ in frames)
+        for _, size, file_name in sorted(frames):
+            if total_size <= self.max_size_bytes:
+                break
+            try:
+                # open memory maps of the frame stay valid after the unlink
+                os.remove(os.path.join(self.cache_dir, file_name))
+            except FileNotFoundError:
+                pass
+            total_size -= size
+
+    def get(self, image_path: str) -> np.ndarray:
+        frame_path = self._frame_path(image_path)
+        try:
+            frame = np.load(frame_path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            frame = None
+        if frame is not None:
+            try:
+                os.utime(frame_path)
+            except FileNotFoundError:
+                pass
+            return frame
+
+        frame = self._decode(image_path)
+        if frame.nbytes <= self.max_size_bytes:
+            self._store(frame_path, frame)
+            self._evict()
+        return frame
@@ -1,20 +1,37 @@
 import os
 import pathlib
-import re
 import time
 from typing import List
 import shutil
+import asyncio
+import collections
+import concurrent.futures
+import multiprocessing
+import threading
 
 from absl import app, flags
 import numpy as np
 import matplotlib.pyplot as plt
 
 import s3_util
+from data_layout import (
+    ANNOTATION_DIR_NAME,
+    IMAGE_DIR_NAME,
+    MANIFEST_DIR_NAME,
+    manifest_file_sort,
+)
 from gui import GUI, AnnotatedImage, Category
-
-IMAGE_DIR_NAME = "images"
-ANNOTATION_DIR_NAME = "annotations"
-MANIFEST_DIR_NAME = "manifests"
+from image_cache import ImageCache
+from pascal_voc import write_pascal_voc
+from preannotate import PreAnnotator
+from review import AnnotationPrefetcher
+from s3_transport import AsyncS3Transport, BackgroundTransport
+from shards import SHARD_DIR_NAME, fetch_images_from_shards
+
+CACHE_DIR_NAME = "cache"
+TILE_CACHE_DIR_NAME = "tiles"
+PROPOSAL_CACHE_DIR_NAME = "proposals"
+FRAME_CACHE_DIR_NAME = "frames"
 
 flags.DEFINE_string(
     "label_file_path",
@@ -32,6 +49,30 @@ flags.DEFINE_string(
 
 flags.DEFINE_string("s3_data_dir", "data", "Prefix of the s3 data objects.")
 
+flags.DEFINE_integer(
+    "s3_max_concurrency", 16, "Maximum number of concurrent s3 requests"
+)
+
+flags.DEFINE_string(
+    "s3_endpoint_url", None, "Endpoint of an S3 compatible store, defaults to AWS."
+)
+
+flags.DEFINE_integer(
+    "export_workers", None, "Number of processes writing the annotation files"
+)
+
+flags.DEFINE_integer(
+    "export_queue_depth",
+    32,
+    "Maximum number of annotations being written or uploaded at the same time",
+)
+
+flags.DEFINE_bool(
+    "use_s3_shards",
+    False,
+    "Retrieve the images from the packed shards created by make_shards.py.",
+)
+
 
 flags.DEFINE_string("image_file_type", "jpg", "File type of the image files")
 
@@ -39,6 +80,61 @@ flags.DEFINE_string("annotation_file_type", "xml", "File type of the annotation
 
 flags.DEFINE_string("manifest_file_type", "txt", "File type of the manifest files")
 
+flags.DEFINE_bool(
+    "viewport",
+    False,
+    "Display images in a zoomable viewport backed by a tile pyramid cached on disk.",
+)
+
+flags.DEFINE_integer("tile_size", 512, "Size in pixels of the viewport pyramid tiles")
+
+flags.DEFINE_integer(
+    "tile_cache_size_mb", 8192, "Disk budget of the viewport tile pyramid cache"
+)
+
+flags.DEFINE_integer(
+    "image_cache_size_mb",
+    0,
+    "Disk budget of the decoded display resolution image cache shared between "
+    "sessions, 0 disables the cache and displays the full resolution images.",
+)
+
+flags.DEFINE_integer(
+    "display_max_size", 2048, "Maximum width or height of the cached display images"
+)
+
+flags.DEFINE_bool(
+    "review",
+    False,
+    "Review the images in the newest manifest instead of labeling new images.",
+)
+
+flags.DEFINE_integer(
+    "review_prefetch_count", 8, "Number of upcoming annotation files parsed ahead"
+)
+
+flags.DEFINE_string(
+    "preannotate_model_path",
+    None,
+    "Path to an ONNX (.onnx) or TorchScript model used to propose bounding boxes.",
+)
+
+flags.DEFINE_integer(
+    "preannotate_batch_size", 4, "Number of images per pre-annotation batch"
+)
+
+flags.DEFINE_integer(
+    "preannotate_workers", 2, "Number of pre-annotation worker processes"
+)
+
+flags.DEFINE_integer(
+    "preannotate_input_size", 640, "Square input size in pixels of the model"
+)
+
+flags.DEFINE_float(
+    "preannotate_score_threshold", 0.5, "Minimum score of a proposed bounding box"
+)
+
 
 def get_files_from_dir(dir_path: str, file_type: str = None) -> List[str]:
     if not os.path.isdir(dir_path):
@@ -51,13 +147,6 @@ def get_files_from_dir(dir_path: str, file_type: str = None) -> List[str]:
     return file_paths
 
 
-def manifest_file_sort(manifest_file) -> int:
-    match = re.match("[0-9]+", manifest_file)
-    if not match:
-        return 0
-    return int(match[0])
-
-
 def get_newest_manifest_path() -> str:
     manifest_files = get_files_from_dir(
         os.path.join(flags.FLAGS.local_data_dir, MANIFEST_DIR_NAME)
@@ -75,11 +164,47 @@ def get_newest_manifest_path() -> str:
     )
 
 
+async def download_s3_data(transport: AsyncS3Transport) -> None:
+    async def download_dir(dir_name: str, file_type: str) -> None:
+        object_names = await transport.list_objects(
+            flags.FLAGS.s3_bucket_name,
+            flags.FLAGS.s3_data_dir + "/" + dir_name,
+            file_type,
+        )
+        if dir_name == IMAGE_DIR_NAME and flags.FLAGS.use_s3_shards:
+            sharded_images = set(
+                await fetch_images_from_shards(
+                    transport,
+                    flags.FLAGS.s3_bucket_name,
+                    flags.FLAGS.s3_data_dir + "/" + SHARD_DIR_NAME,
+                    os.path.join(flags.FLAGS.local_data_dir, IMAGE_DIR_NAME),
+                )
+            )
+            # images added since the shards were last built are fetched one by one
+            object_names = [
+                object_name
+                for object_name in object_names
+                if os.path.basename(object_name) not in sharded_images
+            ]
+        await transport.download_files(
+            flags.FLAGS.s3_bucket_name,
+            object_names,
+            os.path.join(flags.FLAGS.local_data_dir, dir_name),
+        )
+
+    await asyncio.gather(
+        download_dir(IMAGE_DIR_NAME, flags.FLAGS.image_file_type),
+        download_dir(ANNOTATION_DIR_NAME, flags.FLAGS.annotation_file_type),
+        download_dir(MANIFEST_DIR_NAME, None),
+    )
+
+
 def save_outputs(
     annotatedImages: List[AnnotatedImage],
     previous_manifest_path: str,
     start_time: int,
-    use_s3: bool,
+    transport: BackgroundTransport = None,
+    review: bool = False,
 ) -> None:
     # create a new manifest file
     new_manifest_path = os.path.join(
@@ -92,36 +217,107 @@ def save_outputs(
     else:
         open(new_manifest_path, "a").close()
 
-    new_annotation_filepaths = []
-    with open(new_manifest_path, "a") as manifest:
-        for image in annotatedImages:
-            annotation_filepath = image.write_to_pascal_voc()
-            image_filename = os.path.basename(image.image_path)
-            annotation_filename = (
-                os.path.basename(annotation_filepath)
-                if annotation_filepath is not None
-                else "Invalid"
+    # Annotations are serialized by a process pool and uploaded through the shared
+    # s3 transport, both fed through queues bounded by the export queue depth
+    upload_slots = threading.BoundedSemaphore(flags.FLAGS.export_queue_depth)
+    upload_futures = []
+
+    def upload(file_path: str, dir_name: str, overwrite: bool = False) -> None:
+        upload_slots.acquire()
+        future = transport.submit(
+            transport.transport.upload_files(
+                flags.FLAGS.s3_bucket_name,
+                [file_path],
+                flags.FLAGS.s3_data_dir + "/" + dir_name,
+                overwrite=overwrite,
             )
-            if annotation_filepath is not None:
-                new_annotation_filepaths.append(annotation_filepath)
-            manifest.write("%s,%s\n" % (image_filename, annotation_filename,))
-    if use_s3:
-        s3_util.upload_files(
-            flags.FLAGS.s3_bucket_name,
-            new_annotation_filepaths,
-            flags.FLAGS.s3_data_dir + "/" + ANNOTATION_DIR_NAME,
         )
-        s3_util.upload_files(
-            flags.FLAGS.s3_bucket_name,
-            [new_manifest_path],
-            flags.FLAGS.s3_data_dir + "/" + MANIFEST_DIR_NAME,
+        future.add_done_callback(lambda _: upload_slots.release())
+        upload_futures.append(future)
+
+    pending = collections.deque()
+    exported_count = 0
+    # reviewed images replace their existing manifest entries instead of being added
+    reviewed_entries = dict()
+
+    def finish_oldest(manifest) -> None:
+        nonlocal exported_count
+        image, annotation_filepath, future = pending.popleft()
+        exported_count += 1
+        if future is not None:
+            try:
+                future.result()
+            except Exception as e:
+                # leave the image out of the manifest so it is labeled again
+                print("Failed to save annotation %s: %s" % (annotation_filepath, e))
+                return
+        image_filename = os.path.basename(image.image_path)
+        annotation_filename = (
+            os.path.basename(annotation_filepath)
+            if annotation_filepath is not None
+            else "Invalid"
         )
-        # ensure that all images have been uploaded
-        s3_util.upload_files(
-            flags.FLAGS.s3_bucket_name,
-            [image.image_path for image in annotatedImages],
-            flags.FLAGS.s3_data_dir + "/" + IMAGE_DIR_NAME,
+        if review:
+            reviewed_entries[image_filename] = annotation_filename
+        else:
+            manifest.write("%s,%s\n" % (image_filename, annotation_filename,))
+        print(
+            "Saved annotation for %s, %i/%i"
+            % (image_filename, exported_count, len(annotatedImages))
         )
+        if transport is not None:
+            if annotation_filepath is not None:
+                # reviewed annotations replace the existing s3 objects
+                upload(annotation_filepath, ANNOTATION_DIR_NAME, overwrite=review)
+            # ensure that all images have been uploaded
+            upload(image.image_path, IMAGE_DIR_NAME)
+
+    # the transport and prefetcher threads are running, forking could copy a lock
+    # held by one of them, so the workers are spawned
+    with concurrent.futures.ProcessPoolExecutor(
+        flags.FLAGS.export_workers, mp_context=multiprocessing.get_context("spawn")
+    ) as export_executor, open(new_manifest_path, "a") as manifest:
+        for image in annotatedImages:
+            image.remove_incomplete_boxes()
+            annotation_filepath = image.get_pascal_voc_path()
+            future = None
+            if annotation_filepath is not None:
+                future = export_executor.submit(
+                    write_pascal_voc,
+                    image.image_path,
+                    annotation_filepath,
+                    image.get_pascal_voc_objects(),
+                )
+            pending.append((image, annotation_filepath, future))
+            # finishing in submission order keeps the manifest ordering
+            if len(pending) >= flags.FLAGS.export_queue_depth:
+                finish_oldest(manifest)
+        while len(pending) > 0:
+            finish_oldest(manifest)
+
+    if review:
+        with open(new_manifest_path, "r") as manifest:
+            entries = [line.rstrip().split(",") for line in manifest]
+        with open(new_manifest_path, "w") as manifest:
+            for entry in entries:
+                if entry[0] in reviewed_entries:
+                    entry = [entry[0], reviewed_entries[entry[0]]]
+                manifest.write("%s\n" % ",".join(entry))
+
+    if transport is not None:
+        for future in upload_futures:
+            try:
+                future.result()
+            except Exception as e:
+                print("Upload failed: %s" % e)
+        # upload the manifest last so it only references uploaded files
+        transport.submit(
+            transport.transport.upload_files(
+                flags.FLAGS.s3_bucket_name,
+                [new_manifest_path],
+                flags.FLAGS.s3_data_dir + "/" + MANIFEST_DIR_NAME,
+            )
+        ).result()
 
 
 def create_output_dir(dir_name) -> bool:
@@ -143,13 +339,37 @@ def main(unused_argv):
 
     start_time = time.time()
 
+    tile_cache_dir = None
+    if flags.FLAGS.viewport:
+        tile_cache_dir = os.path.join(
+            flags.FLAGS.local_data_dir, CACHE_DIR_NAME, TILE_CACHE_DIR_NAME
+        )
+
+    image_cache = None
+    if flags.FLAGS.image_cache_size_mb > 0:
+        image_cache = ImageCache(
+            os.path.join(
+                flags.FLAGS.local_data_dir, CACHE_DIR_NAME, FRAME_CACHE_DIR_NAME
+            ),
+            flags.FLAGS.image_cache_size_mb * 1024 * 1024,
+            flags.FLAGS.display_max_size,
+        )
+
     fig = plt.figure()
-    gui = GUI(fig)
+    gui = GUI(
+        fig,
+        tile_cache_dir=tile_cache_dir,
+        tile_size=flags.FLAGS.tile_size,
+        tile_cache_size_bytes=flags.FLAGS.tile_cache_size_mb * 1024 * 1024,
+        image_cache=image_cache,
+    )
 
     use_s3 = True if flags.FLAGS.s3_bucket_name is not None else False
 
     if use_s3:
-        if not s3_util.s3_bucket_exists(flags.FLAGS.s3_bucket_name):
+        if not s3_util.s3_bucket_exists(
+            flags.FLAGS.s3_bucket_name, flags.FLAGS.s3_endpoint_url
+        ):
             use_s3 = False
             print(
                 "Bucket: %s either does not exist or you do not have access to it"
@@ -161,43 +381,15 @@ def main(unused_argv):
                 % flags.FLAGS.s3_bucket_name
             )
 
+    transport = None
     if use_s3:
-        # Download new images from s3
-        s3_images = s3_util.s3_get_object_names_from_dir(
-            flags.FLAGS.s3_bucket_name,
-            flags.FLAGS.s3_data_dir + "/" + IMAGE_DIR_NAME,
-            flags.FLAGS.image_file_type,
-        )
-        s3_util.s3_download_files(
-            flags.FLAGS.s3_bucket_name,
-            s3_images,
-            os.path.join(flags.FLAGS.local_data_dir, IMAGE_DIR_NAME),
-        )
-
-        # Download any nest annotation files from s3
-        s3_annotations = s3_util.s3_get_object_names_from_dir(
-            flags.FLAGS.s3_bucket_name,
-            flags.FLAGS.s3_data_dir + "/" + ANNOTATION_DIR_NAME,
-            flags.FLAGS.annotation_file_type,
-        )
-
-        s3_util.s3_download_files(
-            flags.FLAGS.s3_bucket_name,
-            s3_annotations,
-            os.path.join(flags.FLAGS.local_data_dir, ANNOTATION_DIR_NAME),
-        )
-
-        # Download any new manifests files from s3
-        s3_manifests = s3_util.s3_get_object_names_from_dir(
-            flags.FLAGS.s3_bucket_name,
-            flags.FLAGS.s3_data_dir + "/" + MANIFEST_DIR_NAME,
-        )
-
-        s3_util.s3_download_files(
-            flags.FLAGS.s3_bucket_name,
-            s3_manifests,
-            os.path.join(flags.FLAGS.local_data_dir, MANIFEST_DIR_NAME),
+        transport = BackgroundTransport(
+            AsyncS3Transport(
+                flags.FLAGS.s3_max_concurrency, flags.FLAGS.s3_endpoint_url
+            )
         )
+        # Download new images, annotations and manifests from s3 concurrently
+        transport.submit(download_s3_data(transport.transport)).result()
 
     if not os.path.isfile(flags.FLAGS.label_file_path):
         print("Invalid category labels path.")
@@ -226,12 +418,47 @@ def main(unused_argv):
             for line in manifest:
                 manifest_images.add(line.split(",")[0].rstrip())
 
+    annotation_loader = None
+    if flags.FLAGS.review:
+        if previous_manifest_file is None:
+            print("No manifest found to review")
+            return
+        annotation_loader = AnnotationPrefetcher(flags.FLAGS.review_prefetch_count)
+        gui.set_annotation_loader(annotation_loader)
+        # queue the labeled images in manifest order, later entries take precedence
+        manifest_entries = dict()
+        with open(previous_manifest_file, "r") as manifest:
+            for line in manifest:
+                entry = line.rstrip().split(",")
+                if len(entry) == 2:
+                    manifest_entries.pop(entry[0], None)
+                    manifest_entries[entry[0]] = entry[1]
+        for image_file, annotation_file in manifest_entries.items():
+            image_path = os.path.join(
+                flags.FLAGS.local_data_dir, IMAGE_DIR_NAME, image_file
+            )
+            if not os.path.isfile(image_path):
+                print("Image %s in the manifest is missing" % image_path)
+                continue
+            image = AnnotatedImage(
+                image_path,
+                os.path.join(flags.FLAGS.local_data_dir, ANNOTATION_DIR_NAME),
+            )
+            if annotation_file == "Invalid":
+                image.valid = False
+            else:
+                image.annotation_path = os.path.join(
+                    flags.FLAGS.local_data_dir, ANNOTATION_DIR_NAME, annotation_file
+                )
+            gui.add_image(image)
+
     # read in the names of the images to label
     for image_file in os.listdir(
         os.path.join(flags.FLAGS.local_data_dir, IMAGE_DIR_NAME)
     ):
         if (
-            image_file.endswith(flags.FLAGS.image_file_type)
+            not flags.FLAGS.review
+            and image_file.endswith(flags.FLAGS.image_file_type)
             and os.path.basename(image_file) not in manifest_images
         ):
             gui.add_image(
@@ -259,8 +486,43 @@ def main(unused_argv):
         print("Cannot create output manifests directory")
         return
 
-    annotated_images = gui.show()
-    save_outputs(annotated_images, previous_manifest_file, start_time, use_s3)
+    # the pre-annotator is created last, so that no early return leaves its
+    # queued inference running
+    pre_annotator = None
+    if flags.FLAGS.preannotate_model_path is not None:
+        if not os.path.isfile(flags.FLAGS.preannotate_model_path):
+            print("Invalid pre-annotation model path.")
+            return
+        pre_annotator = PreAnnotator(
+            flags.FLAGS.preannotate_model_path,
+            category_labels,
+            os.path.join(
+                flags.FLAGS.local_data_dir, CACHE_DIR_NAME, PROPOSAL_CACHE_DIR_NAME
+            ),
+            batch_size=flags.FLAGS.preannotate_batch_size,
+            num_workers=flags.FLAGS.preannotate_workers,
+            input_size=flags.FLAGS.preannotate_input_size,
+            score_threshold=flags.FLAGS.preannotate_score_threshold,
+        )
+        pre_annotator.submit([image.image_path for image in gui.images])
+        gui.set_pre_annotator(pre_annotator)
+
+    try:
+        annotated_images = gui.show()
+    finally:
+        if pre_annotator is not None:
+            pre_annotator.shutdown()
+    if annotation_loader is not None:
+        annotation_loader.shutdown()
+    save_outputs(
+        annotated_images,
+        previous_manifest_file,
+        start_time,
+        transport,
+        review=flags.FLAGS.review,
+    )
+    if transport is not None:
+        transport.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,60 @@
+import asyncio
+
+from absl import app, flags
+
+from data_layout import IMAGE_DIR_NAME
+import s3_util
+from s3_transport import AsyncS3Transport
+from shards import SHARD_DIR_NAME, build_shards
+
+flags.DEFINE_string("s3_bucket_name", None, "S3 bucket containing the images.")
+
+flags.DEFINE_string("s3_data_dir", "data", "Prefix of the s3 data objects.")
+
+flags.DEFINE_string("image_file_type", "jpg", "File type of the image files")
+
+flags.DEFINE_integer("images_per_shard", 1000, "Number of images packed in each shard")
+
+flags.DEFINE_integer(
+    "s3_max_concurrency", 16, "Maximum number of concurrent s3 requests"
+)
+
+flags.DEFINE_string(
+    "s3_endpoint_url", None, "Endpoint of an S3 compatible store, defaults to AWS."
+)
+
+flags.mark_flag_as_required("s3_bucket_name")
+
+
+def main(unused_argv):
+    if not s3_util.s3_bucket_exists(
+        flags.FLAGS.s3_bucket_name, flags.FLAGS.s3_endpoint_url
+    ):
+        print(
+            "Bucket: %s either does not exist or you do not have access to it"
+            % flags.FLAGS.s3_bucket_name
+        )
+        return
+
+    transport = AsyncS3Transport(
+        flags.FLAGS.s3_max_concurrency, flags.FLAGS.s3_endpoint_url
+    )
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(
+            build_shards(
+                transport,
+                flags.FLAGS.s3_bucket_name,
+                flags.FLAGS.s3_data_dir + "/" + IMAGE_DIR_NAME,
+                flags.FLAGS.s3_data_dir + "/" + SHARD_DIR_NAME,
+                flags.FLAGS.image_file_type,
+                flags.FLAGS.images_per_shard,
+            )
+        )
+    finally:
+        loop.close()
+        transport.close()
+
+
+if __name__ == "__main__":
+    app.run(main)
@@ -0,0 +1,32 @@
+import xml.etree.ElementTree as ET
+from typing import List, Tuple
+
+from pascal_voc_writer import Writer
+from PIL import Image
+
+# (category, xmin, ymin, xmax, ymax)
+PascalVocObject = Tuple[str, int, int, int, int]
+
+
+def write_pascal_voc(
+    image_path: str, annotation_path: str, objects: List[PascalVocObject]
+) -> None:
+    width, height = Image.open(image_path).size
+    writer = Writer(image_path, width, height)
+    for obj in objects:
+        writer.addObject(*obj)
+    writer.save(annotation_path)
+
+
+def read_pascal_voc(annotation_path: str) -> List[PascalVocObject]:
+    root = ET.parse(annotation_path).getroot()
+    return [
+        (
+            obj.findtext("name"),
+            int(float(obj.findtext("bndbox/xmin"))),
+            int(float(obj.findtext("bndbox/ymin"))),
+            int(float(obj.findtext("bndbox/xmax"))),
+            int(float(obj.findtext("bndbox/ymax"))),
+        )
+        for obj in root.iter("object")
+    ]
@@ -0,0 +1,200 @@
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import pathlib
+from typing import Dict, List
+
+import numpy as np
+from PIL import Image
+
+from image_cache import get_image_cache_key
+
+# Per worker process state, populated by _init_worker
+_detector = None
+_detector_config = None
+
+
+class Detector:
+    # Wraps an exported CPU detection model. The model takes a float32 NCHW batch
+    # of RGB images scaled to [0, 1] and returns (boxes, labels, scores) with
+    # shapes (B, N, 4), (B, N) and (B, N), boxes being xmin, ymin, xmax, ymax in
+    # input pixels and labels being indices into the category labels file.
+    def __init__(self, model_path: str):
+        self.model_path = model_path
+        if model_path.lower().endswith(".onnx"):
+            import onnxruntime
+
+            self.session = onnxruntime.InferenceSession(
+                model_path, providers=["CPUExecutionProvider"]
+            )
+            self.input_name = self.session.get_inputs()[0].name
+            self.backend = "onnx"
+        else:
+            import torch
+
+            self.model = torch.jit.load(model_path, map_location="cpu").eval()
+            self.backend = "torchscript"
+
+    def __call__(self, batch: np.ndarray):
+        if self.backend == "onnx":
+            boxes, labels, scores = self.session.run(None, {self.input_name: batch})[:3]
+            return np.asarray(boxes), np.asarray(labels), np.asarray(scores)
+
+        import torch
+
+        with torch.no_grad():
+            boxes, labels, scores = self.model(torch.from_numpy(batch))[:3]
+        return boxes.numpy(), labels.numpy(), scores.numpy()
+
+
+def _init_worker(model_path, input_size, score_threshold, category_labels) -> None:
+    global _detector, _detector_config
+    _detector = Detector(model_path)
+    _detector_config = (input_size, score_threshold, category_labels)
+
+
+def _write_proposals(cache_path: str, proposals: List[Dict]) -> None:
+    tmp_path = "%s.%i.tmp" % (cache_path, os.getpid())
+    with open(tmp_path, "w") as cache_file:
+        json.dump(proposals, cache_file)
+    os.replace(tmp_path, cache_path)
+
+
+def _detect_batch(image_paths: List[str], cache_paths: List[str]) -> List[List[Dict]]:
+    input_size, score_threshold, category_labels = _detector_config
+    batch = np.zeros((len(image_paths), 3, input_size, input_size), dtype=np.float32)
+    image_sizes = []
+    for index, image_path in enumerate(image_paths):
+        image = Image.open(image_path).convert("RGB")
+        image_sizes.append(image.size)
+        resized = image.resize((input_size, input_size), Image.BILINEAR)
+        batch[index] = np.asarray(resized, dtype=np.float32).transpose(2, 0, 1) / 255
+
+    boxes, labels, scores = _detector(batch)
+
+    batch_proposals = []
+    for index, (width, height) in enumerate(image_sizes):
+        keep = (scores[index] >= score_threshold) & (labels[index] >= 0)
+        keep &= labels[index] < len(category_labels)
+        # scale boxes from model input space back to full resolution pixels
+        image_boxes = (
+            boxes[index][keep]
+            * np.array([width, height, width, height], dtype=np.float32)
+            / np.float32(input_size)
+        )
+        image_boxes[:, 0::2] = np.clip(image_boxes[:, 0::2], 0, width - 1)
+        image_boxes[:, 1::2] = np.clip(image_boxes[:, 1::2], 0, height - 1)
+        proposals = [
+            {
+                "category": category_labels[int(label)],
+                "xmin": int(box[0]),
+                "ymin": int(box[1]),
+                "xmax": int(box[2]),
+                "ymax": int(box[3]),
+                "score": float(score),
+            }
+            for box, label, score in zip(
+                image_boxes, labels[index][keep], scores[index][keep]
+            )
+            if int(box[2]) > int(box[0]) and int(box[3]) > int(box[1])
+        ]
+        _write_proposals(cache_paths[index], proposals)
+        batch_proposals.append(proposals)
+    return batch_proposals
+
+
+class PreAnnotator:
+    def __init__(
+        self,
+        model_path: str,
+        category_labels: List[str],
+        cache_dir: str,
+        batch_size: int = 4,
+        num_workers: int = 2,
+        input_size: int = 640,
+        score_threshold: float = 0.5,
+    ):
+        self.model_path = model_path
+        self.category_labels = category_labels
+        self.batch_size = batch_size
+        # proposals depend on the image, the model that produced them and the
+        # settings used to filter its outputs
+        settings_key = "%s:%i:%r:%s" % (
+            get_image_cache_key(model_path),
+            input_size,
+            score_threshold,
+            "\n".join(category_labels),
+        )
+        self.cache_dir = os.path.join(
+            cache_dir, hashlib.sha1(settings_key.encode("utf-8")).hexdigest()
+        )
+        pathlib.Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        # spawned rather than forked from the threaded GUI process
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+            initargs=(model_path, input_size, score_threshold, category_labels),
+        )
+        self.futures: Dict[str, concurrent.futures.Future] = dict()
+        self.batch_indices: Dict[str, int] = dict()
+
+    def _cache_path(self, image_path: str) -> str:
+        return os.path.join(self.cache_dir, get_image_cache_key(image_path) + ".json")
+
+    def submit(self, image_paths: List[str]) -> None:
+        # queue the images without cached proposals in labeling order
+        uncached = [
+            image_path
+            for image_path in image_paths
+            if image_path not in self.futures
+            and not os.path.isfile(self._cache_path(image_path))
+        ]
+        print(
+            "Pre-annotating %i images, %i already cached"
+            % (len(uncached), len(image_paths) - len(uncached))
+        )
+        for start in range(0, len(uncached), self.batch_size):
+            batch = uncached[start : start + self.batch_size]
+            future = self.executor.submit(
+                _detect_batch, batch, [self._cache_path(path) for path in batch]
+            )
+            for batch_index, image_path in enumerate(batch):
+                self.futures[image_path] = future
+                self.batch_indices[image_path] = batch_index
+
+    def proposals_ready(self, image_path: str) -> bool:
+        # get_proposals only blocks while this is False
+        return (
+            image_path not in self.futures
+            or self.futures[image_path].done()
+            or os.path.isfile(self._cache_path(image_path))
+        )
+
+    def get_proposals(self, image_path: str) -> List[Dict]:
+        cache_path = self._cache_path(image_path)
+        if os.path.isfile(cache_path):
+            with open(cache_path, "r") as cache_file:
+                proposals = json.load(cache_file)
+        elif image_path in self.futures:
+            try:
+                proposals = self.futures[image_path].result()[
+                    self.batch_indices[image_path]
+                ]
+            except Exception as e:
+                print("Pre-annotation failed for %s: %s" % (image_path, e))
+                return []
+        else:
+            return []
+        return [
+            proposal
+            for proposal in proposals
+            if proposal["category"] in self.category_labels
+        ]
+
+    def shutdown(self) -> None:
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,181 @@
+import math
+import os
+import pathlib
+import shutil
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image
+
+from image_cache import get_image_cache_key
+
+
+class TilePyramid:
+    LEVEL_FILE_TEMPLATE = "level-%i.npy"
+
+    def __init__(
+        self,
+        image_path: str,
+        cache_dir: str,
+        tile_size: int = 512,
+        max_cache_size_bytes: int = None,
+    ):
+        self.image_path = image_path
+        self.tile_size = tile_size
+        self.cache_root = cache_dir
+        self.cache_dir = os.path.join(cache_dir, get_image_cache_key(image_path))
+        self.levels: List[np.ndarray] = []
+        if self._load_levels():
+            # the directory modification time is the LRU clock of the cache
+            os.utime(self.cache_dir)
+        else:
+            self._build_levels()
+            self._load_levels()
+            if max_cache_size_bytes is not None:
+                self._evict(max_cache_size_bytes)
+
+    @property
+    def width(self) -> int:
+        return self.levels[0].shape[1]
+
+    @property
+    def height(self) -> int:
+        return self.levels[0].shape[0]
+
+    def _level_path(self, level: int) -> str:
+        return os.path.join(self.cache_dir, self.LEVEL_FILE_TEMPLATE % level)
+
+    def _load_levels(self) -> bool:
+        levels = []
+        level = 0
+        while os.path.isfile(self._level_path(level)):
+            levels.append(np.load(self._level_path(level), mmap_mode="r"))
+            level += 1
+        # a complete pyramid always ends with a level that fits in one tile
+        if len(levels) == 0 or max(levels[-1].shape[:2]) > self.tile_size:
+            return False
+        self.levels = levels
+        return True
+
+    def _write_level(self, level: int, shape: Tuple[int, int], fill) -> None:
+        # write to a temporary file first so other readers never see a partial level,
+        # the name is unique per process as several labelers may build the same one
+        tmp_path = "%s.%i.tmp" % (self._level_path(level), os.getpid())
+        level_array = np.lib.format.open_memmap(
+            tmp_path, mode="w+", dtype=np.uint8, shape=(shape[0], shape[1], 3)
+        )
+        fill(level_array)
+        level_array.flush()
+        del level_array
+        os.replace(tmp_path, self._level_path(level))
+
+    def _build_levels(self) -> None:
+        print("Building tile pyramid for %s" % self.image_path)
+        pathlib.Path(self.cache_dir).mkdir(parents=True, exist_ok=True)
+        # Gigapixel aerial and microscopy images trip PIL's decompression bomb
+        # guard, it is only lifted while the full resolution level is written
+        max_image_pixels = Image.MAX_IMAGE_PIXELS
+        Image.MAX_IMAGE_PIXELS = None
+        try:
+            image = Image.open(self.image_path)
+            width, height = image.size
+            # PIL decodes the whole image at once, so building level 0 needs memory
+            # for the full decoded image. Converting it in strips avoids holding a
+            # second full size RGB copy on top of that.
+            image.load()
+
+            def fill_full_resolution(level_array):
+                for top in range(0, height, self.tile_size):
+                    bottom = min(top + self.tile_size, height)
+                    strip = image.crop((0, top, width, bottom)).convert("RGB")
+                    level_array[top:bottom] = np.asarray(strip)
+
+            self._write_level(0, (height, width), fill_full_resolution)
+        finally:
+            Image.MAX_IMAGE_PIXELS = max_image_pixels
+
+        level = 0
+        while max(width, height) > self.tile_size:
+            previous = np.load(self._level_path(level), mmap_mode="r")
+            width, height = math.ceil(width / 2), math.ceil(height / 2)
+
+            def fill_downsampled(level_array):
+                # downsample in strips of whole tiles to keep memory bounded
+                strip_rows = 2 * self.tile_size
+                for top in range(0, previous.shape[0], strip_rows):
+                    strip = previous[top : top + strip_rows]
+                    out_top = top // 2
+                    out_rows = math.ceil(strip.shape[0] / 2)
+                    resized = Image.fromarray(np.asarray(strip)).resize(
+                        (width, out_rows), Image.BILINEAR
+                    )
+                    level_array[out_top : out_top + out_rows] = np.asarray(resized)
+
+            level += 1
+            self._write_level(level, (height, width), fill_downsampled)
+            del previous
+
+    def _evict(self, max_size_bytes: int) -> None:
+        pyramids = []
+        for pyramid_name in os.listdir(self.cache_root):
+            pyramid_dir = os.path.join(self.cache_root, pyramid_name)
+            if pyramid_dir == self.cache_dir or not os.path.isdir(pyramid_dir):
+                continue
+            try:
+                size = sum(
+                    os.path.getsize(os.path.join(pyramid_dir, f))
+                    for f in os.listdir(pyramid_dir)
+                )
+                pyramids.append((os.stat(pyramid_dir).st_mtime, size, pyramid_dir))
+            except FileNotFoundError:
+                # evicted by another process
+                continue
+
+        total_size = sum(size for _, size, _ in pyramids) + sum(
+            level.nbytes for level in self.levels
+        )
+        for _, size, pyramid_dir in sorted(pyramids):
+            if total_size <= max_size_bytes:
+                break
+            # open memory maps of the levels stay valid after the removal
+            shutil.rmtree(pyramid_dir, ignore_errors=True)
+            total_size -= size
+
+    def get_level_for_scale(self, image_pixels_per_screen_pixel: float) -> int:
+        if image_pixels_per_screen_pixel <= 1:
+            return 0
+        level = int(math.floor(math.log2(image_pixels_per_screen_pixel)))
+        return min(level, len(self.levels) - 1)
+
+    def get_view(
+        self, level: int, x_min: float, x_max: float, y_min: float, y_max: float
+    ) -> Tuple[np.ndarray, Tuple[float, float, float, float]]:
+        # Returns the tiles of the level intersecting the view (given in full
+        # resolution pixel coordinates) and their extent in the same coordinates
+        level_array = self.levels[level]
+        level_height, level_width = level_array.shape[:2]
+        scale = 2 ** level
+
+        def tile_bounds(low: float, high: float, level_size: int) -> Tuple[int, int]:
+            first = max(int(math.floor(low / scale)), 0) // self.tile_size
+            last = int(math.ceil(high / scale)) // self.tile_size + 1
+            return (
+                min(first * self.tile_size, level_size - 1),
+                min(last * self.tile_size, level_size),
+            )
+
+        col_start, col_end = tile_bounds(x_min, x_max, level_width)
+        row_start, row_end = tile_bounds(y_min, y_max, level_height)
+
+        def full_resolution_edge(level_index: int, level_size: int, full_size: int):
+            if level_index >= level_size:
+                return full_size - 0.5
+            return level_index * scale - 0.5
+
+        extent = (
+            full_resolution_edge(col_start, level_width, self.width),
+            full_resolution_edge(col_end, level_width, self.width),
+            full_resolution_edge(row_end, level_height, self.height),
+            full_resolution_edge(row_start, level_height, self.height),
+        )
+        return level_array[row_start:row_end, col_start:col_end], extent
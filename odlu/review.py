@@ -0,0 +1,38 @@
+import concurrent.futures
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Optional
+
+from pascal_voc import PascalVocObject, read_pascal_voc
+
+
+class AnnotationPrefetcher:
+    # Parses the existing annotation files of the images ahead of the one being
+    # reviewed on background threads
+    def __init__(self, prefetch_count: int = 8, num_workers: int = 2):
+        self.prefetch_count = prefetch_count
+        self.executor = concurrent.futures.ThreadPoolExecutor(num_workers)
+        self.futures: Dict[str, concurrent.futures.Future] = dict()
+
+    def prefetch(self, annotation_paths: List[str]) -> None:
+        for annotation_path in annotation_paths:
+            if annotation_path is not None and annotation_path not in self.futures:
+                self.futures[annotation_path] = self.executor.submit(
+                    read_pascal_voc, annotation_path
+                )
+
+    def get_objects(self, annotation_path: str) -> Optional[List[PascalVocObject]]:
+        # returns None when the file cannot be read, as opposed to an empty list
+        # for an annotation without objects
+        future = self.futures.pop(annotation_path, None)
+        try:
+            if future is None:
+                return read_pascal_voc(annotation_path)
+            return future.result()
+        except (OSError, ET.ParseError, TypeError, ValueError) as e:
+            print("Could not read annotation %s: %s" % (annotation_path, e))
+            return None
+
+    def shutdown(self) -> None:
+        for future in self.futures.values():
+            future.cancel()
+        self.executor.shutdown(wait=False)
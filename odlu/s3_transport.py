@@ -0,0 +1,172 @@
+import asyncio
+import concurrent.futures
+import os
+import pathlib
+import threading
+from typing import Coroutine, List
+
+import botocore
+
+import s3_util
+
+
+class AsyncS3Transport:
+    # asyncio front end to a single shared boto3 client. boto3 clients are thread
+    # safe, so blocking calls run on a thread pool sized to the concurrency limit
+    # while a semaphore bounds the number of requests in flight. The connection
+    # pool of the client is sized to match.
+    def __init__(self, max_concurrency: int = 16, endpoint_url: str = None):
+        self.client = s3_util.get_s3_client(endpoint_url, max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_concurrency)
+        self._semaphores = dict()
+
+    def _semaphore(self) -> asyncio.Semaphore:
+        # semaphores are bound to the event loop that first uses them
+        loop = asyncio.get_event_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphores[loop]
+
+    async def _call(self, function, *args, **kwargs):
+        async with self._semaphore():
+            return await asyncio.get_event_loop().run_in_executor(
+                self.executor, lambda: function(*args, **kwargs)
+            )
+
+    async def list_objects(
+        self, bucket_name: str, prefix: str, file_type: str = None
+    ) -> List[str]:
+        object_names = []
+        continuation = dict()
+        while True:
+            response = await self._call(
+                self.client.list_objects_v2,
+                Bucket=bucket_name,
+                Prefix=prefix,
+                **continuation
+            )
+            object_names.extend(item["Key"] for item in response.get("Contents", []))
+            if not response.get("IsTruncated"):
+                break
+            continuation = {"ContinuationToken": response["NextContinuationToken"]}
+
+        if file_type is not None:
+            object_names = [
+                object_name
+                for object_name in object_names
+                if object_name.lower().endswith(file_type.lower())
+            ]
+        return object_names
+
+    async def head_object(self, bucket_name: str, s3_object_path: str) -> dict:
+        try:
+            return await self._call(
+                self.client.head_object, Bucket=bucket_name, Key=s3_object_path
+            )
+        except botocore.exceptions.ClientError as e:
+            if e.response["Error"]["Code"] == "404":
+                return None
+            raise
+
+    async def get_object(
+        self, bucket_name: str, s3_object_path: str, destination_file_path: str
+    ) -> None:
+        await self._call(
+            self.client.download_file,
+            bucket_name,
+            s3_object_path,
+            destination_file_path,
+        )
+
+    async def get_object_bytes(
+        self, bucket_name: str, s3_object_path: str, start: int = None, end: int = None
+    ) -> bytes:
+        # start and end are inclusive byte offsets, as in the http range header
+        kwargs = dict()
+        if start is not None:
+            kwargs["Range"] = "bytes=%i-%s" % (start, "" if end is None else end)
+
+        def read() -> bytes:
+            return self.client.get_object(
+                Bucket=bucket_name, Key=s3_object_path, **kwargs
+            )["Body"].read()
+
+        return await self._call(read)
+
+    async def put_object(
+        self, bucket_name: str, file_path: str, s3_object_path: str
+    ) -> None:
+        await self._call(
+            self.client.upload_file, file_path, bucket_name, s3_object_path
+        )
+
+    async def download_files(
+        self, bucket_name: str, s3_object_paths: List[str], destination_dir: str
+    ) -> None:
+        pathlib.Path(destination_dir).mkdir(parents=True, exist_ok=True)
+
+        async def download(s3_object_path: str) -> None:
+            destination_file_path = os.path.join(
+                destination_dir, os.path.basename(s3_object_path)
+            )
+            if os.path.isfile(destination_file_path):
+                return
+            # download to a temporary name so an interrupted transfer is retried
+            tmp_file_path = destination_file_path + ".part"
+            try:
+                await self.get_object(bucket_name, s3_object_path, tmp_file_path)
+            except botocore.exceptions.ClientError as e:
+                print(e)
+                return
+            os.replace(tmp_file_path, destination_file_path)
+            print("Downloaded file from %s:%s" % (bucket_name, s3_object_path))
+
+        await asyncio.gather(*[download(path) for path in s3_object_paths])
+
+    async def upload_files(
+        self,
+        bucket_name: str,
+        files_to_send: List[str],
+        s3_destination_object_dir: str,
+        overwrite: bool = False,
+    ) -> None:
+        async def upload(file_to_send: str) -> None:
+            s3_destination_object_path = (
+                s3_destination_object_dir + "/" + os.path.basename(file_to_send)
+            )
+            try:
+                if not overwrite and await self.head_object(
+                    bucket_name, s3_destination_object_path
+                ):
+                    return
+                await self.put_object(
+                    bucket_name, file_to_send, s3_destination_object_path
+                )
+            except botocore.exceptions.ClientError as e:
+                print(e)
+                return
+            print("Uploaded file to %s:%s" % (bucket_name, s3_destination_object_path))
+
+        await asyncio.gather(*[upload(path) for path in files_to_send])
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=True)
+
+
+class BackgroundTransport:
+    # Runs an event loop on a daemon thread so that transfers can be started from
+    # the Tk event loop without blocking it
+    def __init__(self, transport: AsyncS3Transport):
+        self.transport = transport
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def submit(self, coroutine: Coroutine) -> concurrent.futures.Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def close(self) -> None:
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.transport.close()
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+import pathlib
+import tarfile
+import tempfile
+from typing import Dict, List
+
+import botocore
+
+from s3_transport import AsyncS3Transport
+
+SHARD_DIR_NAME = "shards"
+SHARD_INDEX_FILE_NAME = "index.json"
+SHARD_FILE_TEMPLATE = "shard-%05i.tar"
+
+# Needed members closer together than this are fetched with a single request
+MAX_RANGE_GAP = 1 << 20
+MAX_RANGE_SIZE = 16 << 20
+
+
+async def read_shard_index(
+    transport: AsyncS3Transport, bucket_name: str, shard_dir: str
+) -> Dict:
+    try:
+        index = await transport.get_object_bytes(
+            bucket_name, shard_dir + "/" + SHARD_INDEX_FILE_NAME
+        )
+    except botocore.exceptions.ClientError as e:
+        if e.response["Error"]["Code"] in ["404", "NoSuchKey"]:
+            return {"shards": []}
+        raise
+    return json.loads(index)
+
+
+def _write_shard(shard_path: str, image_paths: List[str]) -> List[Dict]:
+    # Images are stored uncompressed (they already are compressed JPEGs) so that
+    # every member can be read with a byte range request
+    with tarfile.open(shard_path, "w", format=tarfile.USTAR_FORMAT) as shard:
+        for image_path in image_paths:
+            shard.add(image_path, arcname=os.path.basename(image_path))
+    with tarfile.open(shard_path, "r") as shard:
+        return [
+            {"name": member.name, "offset": member.offset_data, "size": member.size}
+            for member in shard.getmembers()
+        ]
+
+
+async def build_shards(
+    transport: AsyncS3Transport,
+    bucket_name: str,
+    image_dir: str,
+    shard_dir: str,
+    file_type: str,
+    images_per_shard: int,
+) -> None:
+    index = await read_shard_index(transport, bucket_name, shard_dir)
+    sharded_images = set(
+        member["name"] for shard in index["shards"] for member in shard["members"]
+    )
+    image_names = [
+        image_name
+        for image_name in await transport.list_objects(
+            bucket_name, image_dir, file_type
+        )
+        if os.path.basename(image_name) not in sharded_images
+    ]
+    print(
+        "Packing %i new images into shards, %i already packed"
+        % (len(image_names), len(sharded_images))
+    )
+
+    for start in range(0, len(image_names), images_per_shard):
+        shard_key = shard_dir + "/" + SHARD_FILE_TEMPLATE % len(index["shards"])
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            batch = image_names[start : start + images_per_shard]
+            await transport.download_files(bucket_name, batch, tmp_dir)
+            # images that failed to download are left for the next run to pack
+            downloaded = [
+                path
+                for path in [os.path.join(tmp_dir, os.path.basename(b)) for b in batch]
+                if os.path.isfile(path)
+            ]
+            if len(downloaded) == 0:
+                print("No images of the batch could be downloaded, skipping shard")
+                continue
+            shard_path = os.path.join(tmp_dir, os.path.basename(shard_key))
+            members = _write_shard(shard_path, downloaded)
+            await transport.put_object(bucket_name, shard_path, shard_key)
+        index["shards"].append({"key": shard_key, "members": members})
+        print("Uploaded shard %s with %i images" % (shard_key, len(members)))
+
+        # upload the index after every shard so an interrupted run can resume
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            index_path = os.path.join(tmp_dir, SHARD_INDEX_FILE_NAME)
+            with open(index_path, "w") as index_file:
+                json.dump(index, index_file)
+            await transport.put_object(
+                bucket_name, index_path, shard_dir + "/" + SHARD_INDEX_FILE_NAME
+            )
+
+
+def _get_ranges(members: List[Dict]) -> List[List[Dict]]:
+    # group members sorted by offset into runs that can be fetched together
+    ranges = []
+    for member in sorted(members, key=lambda m: m["offset"]):
+        if len(ranges) > 0:
+            run_start = ranges[-1][0]["offset"]
+            run_end = ranges[-1][-1]["offset"] + ranges[-1][-1]["size"]
+            if (
+                member["offset"] - run_end <= MAX_RANGE_GAP
+                and member["offset"] + member["size"] - run_start <= MAX_RANGE_SIZE
+            ):
+                ranges[-1].append(member)
+                continue
+        ranges.append([member])
+    return ranges
+
+
+async def fetch_images_from_shards(
+    transport: AsyncS3Transport,
+    bucket_name: str,
+    shard_dir: str,
+    destination_dir: str,
+) -> List[str]:
+    # Writes the sharded images that are not already in the destination dir and
+    # returns the names of all images available from the shards
+    index = await read_shard_index(transport, bucket_name, shard_dir)
+    pathlib.Path(destination_dir).mkdir(parents=True, exist_ok=True)
+
+    async def fetch_range(shard_key: str, members: List[Dict]) -> None:
+        start = members[0]["offset"]
+        end = members[-1]["offset"] + members[-1]["size"]
+        data = await transport.get_object_bytes(bucket_name, shard_key, start, end - 1)
+        for member in members:
+            destination_file_path = os.path.join(destination_dir, member["name"])
+            tmp_file_path = destination_file_path + ".part"
+            member_start = member["offset"] - start
+            with open(tmp_file_path, "wb") as image_file:
+                image_file.write(data[member_start : member_start + member["size"]])
+            os.replace(tmp_file_path, destination_file_path)
+        print("Extracted %i images from %s:%s" % (len(members), bucket_name, shard_key))
+
+    requests = []
+    for shard in index["shards"]:
+        needed = [
+            member
+            for member in shard["members"]
+            if not os.path.isfile(os.path.join(destination_dir, member["name"]))
+        ]
+        requests.extend(
+            fetch_range(shard["key"], members) for members in _get_ranges(needed)
+        )
+    await asyncio.gather(*requests)
+
+    return [member["name"] for shard in index["shards"] for member in shard["members"]]
@@ -0,0 +1,370 @@
+import concurrent.futures
+import os
+import xml.etree.ElementTree as ET
+from typing import Dict, List, Tuple
+
+from absl import app, flags
+import numpy as np
+
+from data_layout import (
+    ANNOTATION_DIR_NAME,
+    IMAGE_DIR_NAME,
+    MANIFEST_DIR_NAME,
+    manifest_file_sort,
+)
+
+BOX_COORDINATES = ["xmin", "ymin", "xmax", "ymax"]
+
+flags.DEFINE_string(
+    "local_data_dir", "../data", "Local directory of the image and annotation files."
+)
+
+flags.DEFINE_string("annotation_file_type", "xml", "File type of the annotation files")
+
+flags.DEFINE_string("manifest_file_type", "txt", "File type of the manifest files")
+
+flags.DEFINE_float(
+    "duplicate_iou_threshold",
+    0.9,
+    "Boxes in the same image overlapping by at least this IoU are duplicates.",
+)
+
+flags.DEFINE_integer("num_workers", None, "Number of XML parsing processes")
+
+flags.DEFINE_integer("parse_chunk_size", 256, "Number of XML files per parsing task")
+
+flags.DEFINE_integer("histogram_bins", 10, "Number of bins of the box size histograms")
+
+flags.DEFINE_integer("max_reported", 20, "Maximum number of problems listed per check")
+
+
+def _find_required(element: ET.Element, tag: str) -> ET.Element:
+    # direct child lookups, element paths are several times slower to evaluate
+    child = element.find(tag)
+    if child is None or child.text is None:
+        raise ValueError("missing <%s> in <%s>" % (tag, element.tag))
+    return child
+
+
+def _parse_annotation_chunk(annotation_paths: List[str]):
+    # Parses a chunk of pascal voc files into flat arrays, categories are encoded
+    # as indices into the chunk local category list
+    image_sizes = np.full((len(annotation_paths), 2), -1, dtype=np.int64)
+    boxes = []
+    box_files = []
+    box_categories = []
+    categories: Dict[str, int] = dict()
+    errors = []
+    for file_index, annotation_path in enumerate(annotation_paths):
+        try:
+            root = ET.parse(annotation_path).getroot()
+            size = root.find("size")
+            if size is None:
+                raise ValueError("missing <size>")
+            image_size = [
+                int(_find_required(size, "width").text),
+                int(_find_required(size, "height").text),
+            ]
+            objects = []
+            for obj in root.iter("object"):
+                bndbox = obj.find("bndbox")
+                if bndbox is None:
+                    raise ValueError("missing <bndbox> in <object>")
+                objects.append(
+                    (
+                        _find_required(obj, "name").text,
+                        [
+                            int(float(_find_required(bndbox, c).text))
+                            for c in BOX_COORDINATES
+                        ],
+                    )
+                )
+        except (OSError, ET.ParseError, TypeError, ValueError) as e:
+            errors.append((annotation_path, str(e)))
+            continue
+        image_sizes[file_index] = image_size
+        for name, box in objects:
+            boxes.append(box)
+            box_files.append(file_index)
+            box_categories.append(categories.setdefault(name, len(categories)))
+    return (
+        image_sizes,
+        np.array(boxes, dtype=np.int64).reshape(-1, 4),
+        np.array(box_files, dtype=np.int64),
+        np.array(box_categories, dtype=np.int64),
+        list(categories),
+        errors,
+    )
+
+
+def load_annotations(annotation_paths: List[str]):
+    chunks = [
+        annotation_paths[start : start + flags.FLAGS.parse_chunk_size]
+        for start in range(0, len(annotation_paths), flags.FLAGS.parse_chunk_size)
+    ]
+    image_sizes = []
+    boxes = []
+    box_files = []
+    box_categories = []
+    categories: Dict[str, int] = dict()
+    errors = []
+    file_offset = 0
+    with concurrent.futures.ProcessPoolExecutor(flags.FLAGS.num_workers) as executor:
+        for chunk, result in zip(chunks, executor.map(_parse_annotation_chunk, chunks)):
+            (
+                chunk_sizes,
+                chunk_boxes,
+                chunk_files,
+                chunk_categories,
+                names,
+                chunk_errors,
+            ) = result
+            # remap the chunk local category indices to global ones
+            category_map = np.array(
+                [categories.setdefault(name, len(categories)) for name in names],
+                dtype=np.int64,
+            )
+            image_sizes.append(chunk_sizes)
+            boxes.append(chunk_boxes)
+            box_files.append(chunk_files + file_offset)
+            box_categories.append(
+                category_map[chunk_categories]
+                if len(chunk_categories) > 0
+                else chunk_categories
+            )
+            errors.extend(chunk_errors)
+            file_offset += len(chunk)
+
+    if len(chunks) == 0:
+        return (
+            np.zeros((0, 2), dtype=np.int64),
+            np.zeros((0, 4), dtype=np.int64),
+            np.zeros(0, dtype=np.int64),
+            np.zeros(0, dtype=np.int64),
+            [],
+            errors,
+        )
+    return (
+        np.concatenate(image_sizes),
+        np.concatenate(boxes),
+        np.concatenate(box_files),
+        np.concatenate(box_categories),
+        list(categories),
+        errors,
+    )
+
+
+def find_out_of_bounds(boxes: np.ndarray, box_image_sizes: np.ndarray) -> np.ndarray:
+    return (
+        (boxes[:, 0] < 0)
+        | (boxes[:, 1] < 0)
+        | (boxes[:, 2] >= box_image_sizes[:, 0])
+        | (boxes[:, 3] >= box_image_sizes[:, 1])
+    )
+
+
+def find_degenerate(boxes: np.ndarray) -> np.ndarray:
+    return (boxes[:, 2] <= boxes[:, 0]) | (boxes[:, 3] <= boxes[:, 1])
+
+
+def _pairwise_iou(rows: np.ndarray, columns: np.ndarray) -> np.ndarray:
+    # (files, rows, 4) x (files, columns, 4) -> (files, rows, columns)
+    x1 = np.maximum(rows[:, :, None, 0], columns[:, None, :, 0])
+    y1 = np.maximum(rows[:, :, None, 1], columns[:, None, :, 1])
+    x2 = np.minimum(rows[:, :, None, 2], columns[:, None, :, 2])
+    y2 = np.minimum(rows[:, :, None, 3], columns[:, None, :, 3])
+    intersection = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+
+    def area(group: np.ndarray) -> np.ndarray:
+        return np.clip(group[:, :, 2] - group[:, :, 0], 0, None) * np.clip(
+            group[:, :, 3] - group[:, :, 1], 0, None
+        )
+
+    union = area(rows)[:, :, None] + area(columns)[:, None, :] - intersection
+    return np.divide(
+        intersection, union, out=np.zeros_like(intersection), where=union > 0
+    )
+
+
+def find_duplicates(
+    boxes: np.ndarray, box_files: np.ndarray, iou_threshold: float
+) -> np.ndarray:
+    # Returns the (box, box) index pairs within the same file with an IoU above the
+    # threshold. Files are grouped by their box count so that the pairwise IoU of
+    # every file in a group is computed with one (files, count, count) operation.
+    # Files with too many boxes for a single operation are split into row blocks.
+    max_pairwise_elements = 1 << 24
+    order = np.argsort(box_files, kind="stable")
+    sorted_files = box_files[order]
+    _, file_starts, file_counts = np.unique(
+        sorted_files, return_index=True, return_counts=True
+    )
+    duplicates = []
+    for count in np.unique(file_counts):
+        if count < 2:
+            continue
+        group_starts = file_starts[file_counts == count]
+        group_size = max(1, max_pairwise_elements // (count * count))
+        row_block_size = max(1, min(count, max_pairwise_elements // count))
+        for start in range(0, len(group_starts), group_size):
+            starts = group_starts[start : start + group_size]
+            indices = order[starts[:, None] + np.arange(count)[None, :]]
+            group = boxes[indices].astype(np.float64)
+            for row_start in range(0, count, row_block_size):
+                row_end = min(row_start + row_block_size, count)
+                iou = _pairwise_iou(group[:, row_start:row_end], group)
+                # only compare each pair once
+                iou *= np.triu(np.ones((row_end - row_start, count)), k=row_start + 1)[
+                    None
+                ]
+                group_index, first, second = np.nonzero(iou >= iou_threshold)
+                duplicates.append(
+                    np.stack(
+                        [
+                            indices[group_index, first + row_start],
+                            indices[group_index, second],
+                        ],
+                        axis=1,
+                    )
+                )
+    if len(duplicates) == 0:
+        return np.zeros((0, 2), dtype=np.int64)
+    return np.concatenate(duplicates)
+
+
+def find_missing_manifest_entries(manifest_path: str) -> List[Tuple[int, str]]:
+    missing = []
+    with open(manifest_path, "r") as manifest:
+        for line_number, line in enumerate(manifest, start=1):
+            entry = line.rstrip().split(",")
+            if len(entry) != 2:
+                missing.append((line_number, "Malformed entry: %s" % line.rstrip()))
+                continue
+            image_filename, annotation_filename = entry
+            image_path = os.path.join(
+                flags.FLAGS.local_data_dir, IMAGE_DIR_NAME, image_filename
+            )
+            if not os.path.isfile(image_path):
+                missing.append((line_number, image_path))
+            if annotation_filename == "Invalid":
+                continue
+            annotation_path = os.path.join(
+                flags.FLAGS.local_data_dir, ANNOTATION_DIR_NAME, annotation_filename
+            )
+            if not os.path.isfile(annotation_path):
+                missing.append((line_number, annotation_path))
+    return missing
+
+
+def print_histogram(title: str, values: np.ndarray) -> None:
+    print(title)
+    if len(values) == 0:
+        return
+    counts, edges = np.histogram(values, bins=flags.FLAGS.histogram_bins)
+    for count, low, high in zip(counts, edges[:-1], edges[1:]):
+        print("  %8.1f - %8.1f: %i" % (low, high, count))
+
+
+def print_problems(title: str, problems: List[str]) -> None:
+    print("%s: %i" % (title, len(problems)))
+    for problem in problems[: flags.FLAGS.max_reported]:
+        print("  %s" % problem)
+    if len(problems) > flags.FLAGS.max_reported:
+        print("  ...")
+
+
+def main(unused_argv):
+    annotation_dir = os.path.join(flags.FLAGS.local_data_dir, ANNOTATION_DIR_NAME)
+    if not os.path.isdir(annotation_dir):
+        print("Invalid annotation directory")
+        return 1
+
+    annotation_paths = sorted(
+        os.path.join(annotation_dir, f)
+        for f in os.listdir(annotation_dir)
+        if f.lower().endswith(flags.FLAGS.annotation_file_type.lower())
+    )
+    (
+        image_sizes,
+        boxes,
+        box_files,
+        box_categories,
+        categories,
+        parse_errors,
+    ) = load_annotations(annotation_paths)
+    print(
+        "Loaded %i bounding boxes from %i annotation files"
+        % (len(boxes), len(annotation_paths))
+    )
+
+    def describe_box(box_index: int) -> str:
+        return "%s: %s %s" % (
+            os.path.basename(annotation_paths[box_files[box_index]]),
+            categories[box_categories[box_index]],
+            boxes[box_index].tolist(),
+        )
+
+    problem_count = len(parse_errors)
+    print_problems(
+        "Unreadable annotation files",
+        ["%s: %s" % (path, error) for path, error in parse_errors],
+    )
+
+    out_of_bounds = np.nonzero(find_out_of_bounds(boxes, image_sizes[box_files]))[0]
+    problem_count += len(out_of_bounds)
+    print_problems(
+        "Out of bounds boxes", [describe_box(index) for index in out_of_bounds]
+    )
+
+    degenerate = np.nonzero(find_degenerate(boxes))[0]
+    problem_count += len(degenerate)
+    print_problems("Degenerate boxes", [describe_box(index) for index in degenerate])
+
+    duplicates = find_duplicates(boxes, box_files, flags.FLAGS.duplicate_iou_threshold)
+    problem_count += len(duplicates)
+    print_problems(
+        "Duplicate boxes",
+        [
+            "%s duplicates %s" % (describe_box(second), boxes[first].tolist())
+            for first, second in duplicates
+        ],
+    )
+
+    manifest_dir = os.path.join(flags.FLAGS.local_data_dir, MANIFEST_DIR_NAME)
+    manifest_files = []
+    if os.path.isdir(manifest_dir):
+        manifest_files = sorted(
+            [
+                f
+                for f in os.listdir(manifest_dir)
+                if f.lower().endswith(flags.FLAGS.manifest_file_type.lower())
+            ],
+            key=manifest_file_sort,
+        )
+    if len(manifest_files) > 0:
+        # every manifest contains the entries of the previous ones
+        manifest_path = os.path.join(manifest_dir, manifest_files[-1])
+        missing = find_missing_manifest_entries(manifest_path)
+        problem_count += len(missing)
+        print_problems(
+            "Missing files in %s" % manifest_files[-1],
+            ["line %i: %s" % (line_number, path) for line_number, path in missing],
+        )
+    else:
+        print("No manifest files found")
+
+    print("Boxes per category:")
+    category_counts = np.bincount(box_categories, minlength=len(categories))
+    for category, count in sorted(zip(categories, category_counts)):
+        print("  %s: %i" % (category, count))
+
+    valid_boxes = ~find_degenerate(boxes)
+    print_histogram("Box width histogram:", (boxes[:, 2] - boxes[:, 0])[valid_boxes])
+    print_histogram("Box height histogram:", (boxes[:, 3] - boxes[:, 1])[valid_boxes])
+
+    print("Found %i problems" % problem_count)
+    return 1 if problem_count > 0 else 0
+
+
+if __name__ == "__main__":
+    app.run(main)